@@ -1,14 +1,32 @@
 from shiny import App, render, ui, reactive
 import polars as pl
 import numpy as np
-import plotly.express as px
+import plotly.graph_objects as go
 from scipy.optimize import curve_fit
+from numba import njit
+import contextlib
+import functools
 import json
+import math
+import os
+import orjson
+import re
+import tempfile
+import time
 from pathlib import Path
+from types import SimpleNamespace
 from shinywidgets import output_widget, render_widget
 
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
 # --- 1. SETUP & DATA LOADING ---
 
+# Bump whenever the load_data() pipeline changes, so stale caches are rebuilt
+ACPH_CACHE_VERSION = 3
+
 def load_data():
     # Adjust path to point to the root of the repo
     # Assuming we run this from the repo root or Session-7 folder
@@ -26,13 +44,44 @@ def load_data():
         # Fallback for demo purposes if files missing
         return pl.DataFrame()
 
-    df_policies = pl.read_parquet(data_dir / "Policy_Book.parquet")
-    df_claims = pl.read_parquet(data_dir / "Claims_Transaction.parquet")
+    # Serve the pre-aggregated ACPH table from cache if the source files
+    # haven't changed since it was written by this version of the pipeline
+    cache_path = data_dir / "acph_cache.parquet"
+    meta_path = data_dir / "acph_cache.json"
+    cache_meta = {
+        "version": ACPH_CACHE_VERSION,
+        "sources": {
+            name: os.stat(data_dir / name).st_mtime_ns
+            for name in ["Policy_Book.parquet", "Claims_Transaction.parquet"]
+        }
+    }
+    # A missing, corrupt or partial cache just means rebuilding it
+    try:
+        with open(meta_path, 'r') as f:
+            if json.load(f) == cache_meta:
+                return pl.read_parquet(cache_path)
+    except (OSError, ValueError, pl.exceptions.PolarsError):
+        pass
+
+    # Scan lazily and project only the columns we use, so Polars prunes
+    # everything else at the Parquet reader. The native scan_parquet reader
+    # streams row groups and pushes projections/predicates down itself, so
+    # there's no need to go through pyarrow.dataset here
+    df_policies = (
+        pl.scan_parquet(data_dir / "Policy_Book.parquet")
+        .select(["PolicyID", "CohortYear", "NumHomes", "ProductType"])
+    )
+    df_claims = (
+        pl.scan_parquet(data_dir / "Claims_Transaction.parquet")
+        .select(["PolicyID", "ReportDate", "PaymentAmount"])
+        # Narrow to Float32 so the join carries half the bytes for it
+        .with_columns(pl.col("PaymentAmount").cast(pl.Float32))
+    )
 
     # 1. Exposure
     df_exposure = (
         df_policies
-        .group_by("CohortYear")
+        .group_by("CohortYear", maintain_order=False)
         .agg(pl.col("NumHomes").sum().alias("TotalHomes"))
     )
 
@@ -43,8 +92,9 @@ def load_data():
         .with_columns(
             (pl.col("ReportDate").dt.year() - pl.col("CohortYear")).alias("DevYear")
         )
-        .group_by(["CohortYear", "DevYear", "ProductType"])
-        .agg(pl.col("PaymentAmount").sum().alias("TotalClaims"))
+        .group_by(["CohortYear", "DevYear", "ProductType"], maintain_order=False)
+        # Accumulate in Float64 so the totals don't lose precision
+        .agg(pl.col("PaymentAmount").cast(pl.Float64).sum().alias("TotalClaims"))
     )
 
     # 3. ACPH
@@ -55,17 +105,205 @@ def load_data():
             (pl.col("TotalClaims") / pl.col("TotalHomes")).alias("ACPH")
         )
         .sort(["ProductType", "CohortYear", "DevYear"])
+        .collect(engine="streaming")
     )
+
+    # Write the cache for next startup. Drop the old metadata first and swap
+    # each file in with os.replace, so a crash mid-write never leaves a cache
+    # that matches its metadata. A read-only data dir just means no cache
+    try:
+        meta_path.unlink(missing_ok=True)
+        tmp_cache_path = cache_path.with_name(cache_path.name + ".tmp")
+        df_acph.write_parquet(tmp_cache_path, compression="zstd")
+        os.replace(tmp_cache_path, cache_path)
+        tmp_meta_path = meta_path.with_name(meta_path.name + ".tmp")
+        with open(tmp_meta_path, 'w') as f:
+            json.dump(cache_meta, f, indent=4)
+        os.replace(tmp_meta_path, meta_path)
+    except OSError:
+        pass
     
     return df_acph
 
 # Load once at startup
 df_acph = load_data() 
 
+# Split by product once so each reactive lookup is a dict hit, not a scan
+ACPH_BY_PRODUCT = {
+    product: shard
+    for (product,), shard in df_acph.partition_by("ProductType", as_dict=True).items()
+} if not df_acph.is_empty() else {}
+# Arrow-backed pandas views of just the grid's columns, served as-is
+GRID_BY_PRODUCT = {
+    product: shard.select(["CohortYear", "DevYear", "ACPH"]).to_pandas(use_pyarrow_extension_array=True)
+    for product, shard in ACPH_BY_PRODUCT.items()
+}
+
 # Curve Definition
+# Compiled to a single fused loop: curve_fit calls this on every iteration
+@njit("void(float64[:], float64[:], float64, float64, float64)", cache=True, fastmath=True)
+def actuarial_curve_into(t, out, A, B, C):
+    for i in range(t.shape[0]):
+        t_safe = t[i] if t[i] > 0.1 else 0.1
+        out[i] = A * t_safe ** B * math.exp(-C * t_safe)
+
+@njit("float64[:](float64[:], float64, float64, float64)", cache=True, fastmath=True)
 def actuarial_curve(t, A, B, C):
-    t_safe = np.maximum(t, 0.1) 
-    return A * (t_safe ** B) * np.exp(-C * t_safe)
+    out = np.empty_like(t)
+    actuarial_curve_into(t, out, A, B, C)
+    return out
+
+# Analytic Jacobian (d/dA, d/dB, d/dC) so curve_fit doesn't finite-difference
+@njit("float64[:, :](float64[:], float64, float64, float64)", cache=True, fastmath=True)
+def actuarial_jac(t, A, B, C):
+    out = np.empty((t.shape[0], 3))
+    for i in range(t.shape[0]):
+        t_safe = t[i] if t[i] > 0.1 else 0.1
+        base = t_safe ** B * math.exp(-C * t_safe)
+        out[i, 0] = base
+        out[i, 1] = A * base * math.log(t_safe)
+        out[i, 2] = -A * base * t_safe
+    return out
+
+# Warm up once at import so the first click doesn't pay for compilation
+actuarial_curve(np.arange(1.0, 4.0), 1.0, 1.0, 1.0)
+actuarial_jac(np.arange(1.0, 4.0), 1.0, 1.0, 1.0)
+
+# Plot grid for the fitted curve, evaluated in place on every redraw
+X_RANGE = np.linspace(0.0, 10.0, 100)
+_Y_FIT_BUF = np.empty_like(X_RANGE)
+
+# Fixed CohortYear colour range, so colours mean the same across products
+COHORT_RANGE = (
+    (df_acph["CohortYear"].min(), df_acph["CohortYear"].max())
+    if not df_acph.is_empty() else (None, None)
+)
+
+# Memoised fit: keyed on product + excluded (CohortYear, DevYear) points so
+# reactive recomputes with an unchanged selection skip curve_fit entirely
+@functools.lru_cache(maxsize=64)
+def _fit(product: str, excluded: frozenset) -> tuple | None:
+    df = ACPH_BY_PRODUCT.get(product, pl.DataFrame())
+    if df.is_empty(): return None
+    
+    # Drop the excluded points
+    df_excluded = pl.DataFrame(
+        list(excluded),
+        schema=df.select(["CohortYear", "DevYear"]).schema,
+        orient="row"
+    )
+    df_clean = df.join(df_excluded, on=["CohortYear", "DevYear"], how="anti")
+    
+    # Average ACPH per DevYear (0-10) to get the pattern to fit. DevYear is a
+    # small non-negative int, so bincount beats a hash group-by here
+    dev = df_clean["DevYear"].to_numpy()
+    acph = df_clean["ACPH"].to_numpy()
+    in_range = (dev >= 0) & (dev <= 10)
+    dev, acph = dev[in_range], acph[in_range]
+    sums = np.bincount(dev, weights=acph, minlength=11)
+    counts = np.bincount(dev, minlength=11)
+    has_data = counts > 0
+    
+    if has_data.sum() < 3: return None # Not enough points
+    
+    x_data = np.nonzero(has_data)[0].astype(np.float64)
+    y_data = sums[has_data] / counts[has_data]
+    
+    try:
+        popt, _ = curve_fit(actuarial_curve, x_data, y_data, p0=[100, 2, 0.5], jac=actuarial_jac, maxfev=5000)
+        return tuple(popt)
+    except:
+        return None
+
+# Pre-fit every product (no exclusions) at startup, so switching product in
+# the UI is a cache hit
+for product in ACPH_BY_PRODUCT:
+    _fit(product, frozenset())
+
+# Assumptions storage: save() appends one line per click to the log, and
+# compact_assumptions() folds the log into assumptions.json at startup and
+# whenever a session ends
+ASSUMPTIONS_PATH = Path("assumptions.json")
+ASSUMPTIONS_LOG_PATH = Path("assumptions.log.jsonl")
+ASSUMPTIONS_LOCK_PATH = Path("assumptions.json.lock")
+
+@contextlib.contextmanager
+def _assumptions_lock():
+    # OS-level lock on a sidecar file, shared by every process appending to or
+    # compacting the log. The OS drops it if the holder dies
+    with open(ASSUMPTIONS_LOCK_PATH, 'a+b') as f:
+        f.seek(0)
+        if os.name == "nt":
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            f.seek(0)
+            if os.name == "nt":
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def compact_assumptions():
+    with _assumptions_lock():
+        # Load existing or create new
+        if ASSUMPTIONS_PATH.exists():
+            data = orjson.loads(ASSUMPTIONS_PATH.read_bytes())
+        else:
+            data = {"products": {}}
+        if "products" not in data: data["products"] = {}
+        
+        # Move the log aside first, so saves that land while we compact go to
+        # a fresh log. Pending logs are named <log>.<ns>.<pid>
+        pending_path = ASSUMPTIONS_LOG_PATH.with_name(
+            f"{ASSUMPTIONS_LOG_PATH.name}.{time.time_ns()}.{os.getpid()}"
+        )
+        try:
+            os.replace(ASSUMPTIONS_LOG_PATH, pending_path)
+        except FileNotFoundError:
+            pass
+        
+        # Also pick up logs left behind by a compaction that didn't finish
+        pending_pattern = re.compile(re.escape(ASSUMPTIONS_LOG_PATH.name) + r"\.(\d+)\.\d+")
+        pending = {}
+        for path in ASSUMPTIONS_LOG_PATH.parent.iterdir():
+            match = pending_pattern.fullmatch(path.name)
+            if match: pending[path] = int(match.group(1))
+        pending_paths = sorted(pending, key=pending.get)
+        if not pending_paths: return data
+        
+        # Replay the logs in order, so the latest save per product wins. Skip
+        # lines torn by a crash mid-append rather than failing the whole replay
+        for path in pending_paths:
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        entry = orjson.loads(line)
+                        points = entry["excluded_points"]
+                        product = data["products"].setdefault(entry["product"], {})
+                    except (ValueError, KeyError, TypeError):
+                        continue
+                    product["excluded_points"] = points
+        
+        # Write to a unique temp file and rename over the original so it's
+        # never torn. Only drop the logs once the new file is in place
+        with tempfile.NamedTemporaryFile(
+            dir=ASSUMPTIONS_PATH.parent,
+            prefix=ASSUMPTIONS_PATH.name + ".",
+            suffix=".tmp",
+            delete=False
+        ) as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        os.replace(f.name, ASSUMPTIONS_PATH)
+        for path in pending_paths:
+            path.unlink()
+        
+        return data
+
+# Fold in anything logged, or left pending, by a previous run
+compact_assumptions()
 
 # --- 2. UI DEFINITION ---
 
@@ -106,20 +344,23 @@ app_ui = ui.page_fluid(
 
 def server(input, output, session):
     
+    # Fold this session's saves into assumptions.json once it closes
+    session.on_ended(compact_assumptions)
+    
+    # Shared per-product view: the Polars frame plus the grid's pandas view,
+    # so every output reads the same prebuilt buffers
     @reactive.Calc
-    def filtered_data():
+    def view():
         selected_product = input.product()
-        if df_acph.is_empty(): return pl.DataFrame()
-        
-        return df_acph.filter(pl.col("ProductType") == selected_product)
+        return SimpleNamespace(
+            pl=ACPH_BY_PRODUCT.get(selected_product, pl.DataFrame()),
+            pd=GRID_BY_PRODUCT.get(selected_product, pl.DataFrame())
+        )
     
     @render.data_frame
     def exclusion_grid():
-        df = filtered_data()
-        if df.is_empty(): return render.DataGrid(pl.DataFrame())
-        
         # Show relevant columns for selection
-        display_df = df.select(["CohortYear", "DevYear", "ACPH"]).to_pandas()
+        display_df = view().pd
         
         return render.DataGrid(
             display_df,
@@ -130,81 +371,100 @@ def server(input, output, session):
     
     @reactive.Calc
     def fitted_curve():
-        df = filtered_data()
+        df = view().pl
         if df.is_empty(): return None
         
         # Get selected rows to exclude
         # input.exclusion_grid.selected_rows() returns a tuple of row indices
         selected_indices = input.exclusion_grid_selected_rows()
         
-        # Create a boolean mask for inclusion
-        # Default is include all
-        include_mask = np.ones(len(df), dtype=bool)
+        # Look up the (CohortYear, DevYear) key of each excluded row
+        excluded = frozenset(
+            df.select(["CohortYear", "DevYear"])[list(selected_indices or [])].iter_rows()
+        )
         
-        if selected_indices:
-            include_mask[list(selected_indices)] = False
-            
-        df_clean = df.filter(pl.Series(include_mask))
+        return _fit(input.product(), excluded)
+    
+    @render_widget
+    def main_plot():
+        # Build the figure once per session; update_plot() patches it in place
+        fig = go.Figure(layout=dict(
+            title="No Data Found",
+            xaxis_title="DevYear",
+            yaxis_title="ACPH",
+            legend=dict(orientation="h", x=0, y=1.0, yanchor="bottom")
+        ))
         
-        # Aggregate to get the pattern to fit
-        df_pattern = (
-            df_clean
-            .group_by("DevYear")
-            .agg(pl.col("ACPH").mean().alias("AvgACPH"))
-            .sort("DevYear")
-            .filter(pl.col("DevYear") <= 10)
-        )
+        # Actuals: one trace coloured by CohortYear, with a per-point symbol
+        # marking excluded points
+        fig.add_trace(go.Scattergl(
+            mode='markers',
+            name='Actuals',
+            showlegend=False,
+            opacity=0.7,
+            marker=dict(
+                colorscale="Plasma",
+                cmin=COHORT_RANGE[0],
+                cmax=COHORT_RANGE[1],
+                colorbar=dict(title="CohortYear")
+            )
+        ))
         
-        if df_pattern.height < 3: return None # Not enough points
+        # Legend-only key for the Included/Excluded symbols
+        for status, symbol in [("Included", "circle"), ("Excluded", "x")]:
+            fig.add_trace(go.Scatter(
+                x=[None],
+                y=[None],
+                mode='markers',
+                name=status,
+                marker=dict(symbol=symbol, color='grey')
+            ))
         
-        x_data = df_pattern["DevYear"].to_numpy()
-        y_data = df_pattern["AvgACPH"].to_numpy()
+        # Fitted Curve
+        fig.add_trace(go.Scatter(
+            x=X_RANGE, 
+            mode='lines', 
+            name='Fitted Curve', 
+            line=dict(color='black', width=4),
+            visible=False
+        ))
         
-        try:
-            popt, _ = curve_fit(actuarial_curve, x_data, y_data, p0=[100, 2, 0.5], maxfev=5000)
-            return popt
-        except:
-            return None
+        return fig
     
-    @render_widget
-    def main_plot():
-        df = filtered_data()
-        if df.is_empty(): return px.scatter(title="No Data Found")
+    @reactive.Effect
+    def update_plot():
+        fig = main_plot.widget
+        if fig is None: return
         
-        # Identify excluded points for visualization
-        selected_indices = input.exclusion_grid_selected_rows() or []
-        df_pd = df.to_pandas()
-        df_pd["Status"] = "Included"
-        if selected_indices:
-            df_pd.iloc[list(selected_indices), df_pd.columns.get_loc("Status")] = "Excluded"
+        df = view().pl
+        if df.is_empty(): return
         
-        # Plot Actuals
-        fig = px.scatter(
-            df_pd, 
-            x="DevYear", 
-            y="ACPH", 
-            color="CohortYear", 
-            symbol="Status", # Different symbol for excluded
-            symbol_map={"Included": "circle", "Excluded": "x"},
-            title=f"ACPH Analysis: {input.product()}",
-            opacity=0.7
-        )
+        # Identify excluded points for visualization
+        selected_indices = list(input.exclusion_grid_selected_rows() or [])
+        symbols = df.with_row_index("_idx").select(
+            pl.when(pl.col("_idx").is_in(selected_indices))
+            .then(pl.lit("x"))
+            .otherwise(pl.lit("circle"))
+        ).to_series()
         
-        # Plot Fitted Curve
         popt = fitted_curve()
-        if popt is not None:
-            x_range = np.linspace(0, 10, 100)
-            y_fit = actuarial_curve(x_range, *popt)
+        
+        with fig.batch_update():
+            fig.layout.title.text = f"ACPH Analysis: {input.product()}"
             
-            fig.add_scatter(
-                x=x_range, 
-                y=y_fit, 
-                mode='lines', 
-                name='Fitted Curve', 
-                line=dict(color='black', width=4)
-            )
+            # Plot Actuals
+            actuals = fig.data[0]
+            actuals.x = df["DevYear"].to_numpy()
+            actuals.y = df["ACPH"].to_numpy()
+            actuals.marker.color = df["CohortYear"].to_numpy()
+            actuals.marker.symbol = symbols.to_numpy()
             
-        return fig
+            # Plot Fitted Curve
+            curve = fig.data[-1]
+            if popt is not None:
+                actuarial_curve_into(X_RANGE, _Y_FIT_BUF, *popt)
+                curve.y = _Y_FIT_BUF
+            curve.visible = popt is not None
     
     @render.table
     def params_table():
@@ -219,38 +479,30 @@ def server(input, output, session):
     @reactive.Effect
     @reactive.event(input.save_btn)
     def save():
-        # Load existing or create new
-        path = Path("assumptions.json")
-        if path.exists():
-            with open(path, 'r') as f:
-                data = json.load(f)
-        else:
-            data = {"products": {}}
-            
-        # Update
         prod = input.product()
-        if "products" not in data: data["products"] = {}
-        if prod not in data["products"]: data["products"][prod] = {}
         
         # Get excluded points
-        df = filtered_data()
+        df = view().pl
         selected_indices = input.exclusion_grid_selected_rows()
         
-        excluded_points = []
-        if selected_indices:
-            excluded_rows = df.filter(pl.Series(np.isin(np.arange(len(df)), list(selected_indices))))
-            for row in excluded_rows.iter_rows(named=True):
-                excluded_points.append({
-                    "CohortYear": row["CohortYear"],
-                    "DevYear": row["DevYear"]
-                })
-        
-        data["products"][prod]["excluded_points"] = excluded_points
+        excluded_points = (
+            df.with_row_index("_idx")
+            .filter(pl.col("_idx").is_in(list(selected_indices or [])))
+            .select(["CohortYear", "DevYear"])
+            .to_dicts()
+        )
         
-        # Save
-        with open(path, 'w') as f:
-            json.dump(data, f, indent=4)
+        # Save: append to the log rather than rewriting assumptions.json.
+        # assumptions.json itself only picks this up when the session ends
+        entry = {"ts": time.time_ns(), "product": prod, "excluded_points": excluded_points}
+        with _assumptions_lock():
+            with open(ASSUMPTIONS_LOG_PATH, 'ab') as f:
+                f.write(orjson.dumps(entry) + b"\n")
             
-        ui.notification_show(f"Saved {len(excluded_points)} exclusions for {prod}!", type="success")
+        ui.notification_show(
+            f"Saved {len(excluded_points)} exclusions for {prod}! "
+            "assumptions.json will be updated when this session ends.",
+            type="success"
+        )
 
 app = App(app_ui, server)
\ No newline at end of file
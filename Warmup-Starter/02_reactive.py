@@ -24,23 +24,29 @@ def server(input, output, session):
         # Task 1: Return array
         return np.random.randint(0, 100, input.n())
 
+    @reactive.calc
+    def stats():
+        # Compute all three stats together, once per new array
+        data = random_data()
+        return data.sum(), data.mean(), data.max()
+
     @render.text
     def sum_out():
         # Task 2: Calculate sum
-        data = random_data()
-        return f"Sum: {np.sum(data)}"
+        total, _, _ = stats()
+        return f"Sum: {total}"
 
     @render.text
     def mean_out():
         # Task 3: Calculate mean
-        data = random_data()
-        return f"Mean: {np.mean(data):.2f}"
+        _, mean, _ = stats()
+        return f"Mean: {mean:.2f}"
 
     @render.text
     def max_out():
         # Task 4: Calculate max
-        data = random_data()
-        return f"Max: {np.max(data)}"
+        _, maximum, _ = stats()
+        return f"Max: {maximum}"
 
 app = App(app_ui, server)
 